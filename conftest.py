@@ -0,0 +1,2 @@
+# Root conftest: makes pytest put the repo root on sys.path, so tests can
+# import tg_prompt_script_bot when run as plain `pytest`.
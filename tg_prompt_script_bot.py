@@ -7,7 +7,7 @@ Features:
 - Rich inline-menu flow for creating prompts (language -> platform -> description -> scenes -> duration)
 - "Mini-AI" local enhancer (heuristic) and optional Deepseek API integration (if DEEPSEEK_API_KEY is set)
 - Commands: /menu, /generate (if flow completed), /improve, /export, /settings
-- Export prompts as ZIP with prompts.json
+- Export prompts as ZIP with prompts.json, or as gzipped MessagePack (/export msgpack)
 Security:
 - DO NOT hardcode TG_TOKEN or DEEPSEEK_API_KEY into files that will be uploaded publicly.
 - Set environment variables on your host (Render/Replit/VPS): TG_TOKEN and optionally DEEPSEEK_API_KEY.
@@ -19,16 +19,40 @@ How to run:
 3) python tg_prompt_script_bot_v3.py
 """
 import os
+import re
+import asyncio
 import logging
 import json
 import random
 import zipfile
-import io
-from pathlib import Path
-from datetime import datetime
-from typing import List, Dict, Any
+import gzip
+import tempfile
+import hashlib
+import time
+import functools
+import itertools
+import uuid
+import weakref
+from typing import List, Dict, Any, Optional, Tuple
 
-import requests
+import aiohttp
+import aiosqlite
+import msgpack
+try:
+    # only needed when sessions are shared through Redis (REDIS_URL)
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
+from cachetools import LRUCache, TTLCache
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    # optional Rust-backed sentence splitter (pip install semantic-text-splitter)
+    from semantic_text_splitter import TextSplitter
+except ImportError:
+    TextSplitter = None
 from telegram import (
     Update,
     InlineKeyboardButton,
@@ -36,7 +60,9 @@ from telegram import (
     InputFile,
 )
 from telegram.ext import (
+    AIORateLimiter,
     ApplicationBuilder,
+    BaseUpdateProcessor,
     CommandHandler,
     ContextTypes,
     MessageHandler,
@@ -62,192 +88,643 @@ LANGUAGES = {
     "tr":"Türkçe","ja":"日本語","ko":"한국어","zh":"中文"
 }
 
-STYLE_POOL = [
+# Read-only pools sampled per scene (tuples: immutable, compact, fast to index)
+STYLE_POOL = (
     "photorealistic","cinematic lighting","anime","art-house","retro 80s","cyberpunk",
     "fantasy","painterly","surreal","documentary","hyper-detailed","low-poly"
-]
-MOOD_POOL = ["tense","dreamy","melancholic","uplifting","ominous","hopeful","mysterious","whimsical"]
+)
+MOOD_POOL = ("tense","dreamy","melancholic","uplifting","ominous","hopeful","mysterious","whimsical")
+CAMERA_MOVES = ("close-up","wide shot","tracking shot","slow zoom","overhead","dolly in")
+COLOR_PALETTES = ("neon blues and magentas","warm golden hour tones","muted earth tones","high-contrast monochrome","pastel palette")
+ADJECTIVES = ("soft","harsh","glowing","muted","vibrant","textured","grainy","pristine")
+
+# Precompiled splitters for split_into_scenes
+_SENT_RE = re.compile(r'(?<=[.!?])\s+')
+_CLAUSE_RE = re.compile(r',\s*')
+# descriptions at least this long go through TextSplitter (if installed)
+SPLITTER_MIN_LEN = 500
+
+# Per-user session storage (in-memory); idle sessions expire after SESSION_TTL
+# seconds and at most SESSION_MAXSIZE users are kept
+SESSION_MAXSIZE = int(os.getenv("SESSION_MAXSIZE", "10000"))
+SESSION_TTL = int(os.getenv("SESSION_TTL", "3600"))
+SESSIONS: "TTLCache[int, Dict[str, Any]]" = TTLCache(maxsize=SESSION_MAXSIZE, ttl=SESSION_TTL)
+
+# Concurrency limits per workload class, so a burst of users can't open unbounded
+# Deepseek connections or pile hundreds of CPU jobs onto the thread pool
+DEEPSEEK_MAX_CONCURRENCY = int(os.getenv("DEEPSEEK_MAX_CONCURRENCY", "50"))
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "64"))
+_API_SEM = asyncio.Semaphore(DEEPSEEK_MAX_CONCURRENCY)
+_CPU_SEM = asyncio.Semaphore((os.cpu_count() or 1) * 2)
+
+async def _run_cpu(func, *args):
+    # CPU-bound work goes to a worker thread, at most _CPU_SEM jobs at a time
+    async with _CPU_SEM:
+        return await asyncio.to_thread(func, *args)
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Runs updates of different users concurrently, but one user's updates one at a
+    time and in order: handlers read, mutate and save the whole session, so two
+    overlapping updates of the same user would double-generate or lose a write.
+    """
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        # a lock lives only while some update of that user holds or awaits it
+        self._locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+    async def process_update(self, update, coroutine):
+        # the base version takes the global MAX_CONCURRENT_UPDATES slot first; take
+        # the user's lock before it instead, so a user's queued burst waits
+        # without holding slots other users need (@final is only a typing hint)
+        user = getattr(update, "effective_user", None)
+        if user is None:
+            await super().process_update(update, coroutine)
+            return
+        lock = self._locks.get(user.id)
+        if lock is None:
+            lock = self._locks[user.id] = asyncio.Lock()
+        async with lock:
+            await super().process_update(update, coroutine)
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
 
-# Per-user session storage (in-memory)
-SESSIONS: Dict[int, Dict[str, Any]] = {}
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
 
 # Utility: main menu keyboard
-def main_menu_kb():
+def _build_main_menu_kb():
     kb = [
         [InlineKeyboardButton("Create Prompts", callback_data="menu_create"),
          InlineKeyboardButton("Improve Last", callback_data="menu_improve")],
         [InlineKeyboardButton("Export", callback_data="menu_export"),
-         InlineKeyboardButton("Settings", callback_data="menu_settings")]
+         InlineKeyboardButton("Export (msgpack)", callback_data="menu_export_msgpack")],
+        [InlineKeyboardButton("Settings", callback_data="menu_settings")]
     ]
     return InlineKeyboardMarkup(kb)
 
-# Utility: keyboard from list
+# stateless, so one instance serves every message and callback
+_MAIN_MENU_KB = _build_main_menu_kb()
+
+# Utility: keyboard from list (markups are immutable, so identical lists share one)
 def keyboard_from_list(items: List[str], row_size=2):
+    return _keyboard_from_tuple(tuple(items), row_size)
+
+@functools.lru_cache(maxsize=128)
+def _keyboard_from_tuple(items: Tuple[str, ...], row_size: int):
     rows=[]
     for i in range(0,len(items),row_size):
         rows.append([InlineKeyboardButton(text=x, callback_data=f"pick|{x}") for x in items[i:i+row_size]])
     return InlineKeyboardMarkup(rows)
 
+# Static pickers, built once and shared by every user
+_LANG_KB = keyboard_from_list([f"{k} — {v}" for k, v in LANGUAGES.items()], row_size=2)
+_PLATFORM_KB = keyboard_from_list(PLATFORMS, row_size=2)
+_SETTINGS_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Toggle Deepseek (env)", callback_data="setting|deepseek")],
+    [InlineKeyboardButton("Back to Menu", callback_data="menu_back")],
+])
+
 # --- Mini-AI enhancer (local heuristics) ---
-def mini_ai_enhance(scene_short: str) -> Dict[str,str]:
-    title = scene_short.strip()[:48].rstrip(" .,!?:;") + ("..." if len(scene_short.strip())>48 else "")
-    style = random.choice(STYLE_POOL)
-    mood = random.choice(MOOD_POOL)
-    camera = random.choice(["close-up","wide shot","tracking shot","slow zoom","overhead","dolly in"])
-    color = random.choice(["neon blues and magentas","warm golden hour tones","muted earth tones","high-contrast monochrome","pastel palette"])
-    adjective = random.choice(["soft","harsh","glowing","muted","vibrant","textured","grainy","pristine"])
+# basic sanitization: remove very explicit violent verbs, all in one regex pass
+BAD_WORDS = ("разстрелять","убить","убивают","shoot","kill")
+_BAD_RE = re.compile("|".join(re.escape(w) for w in BAD_WORDS), re.IGNORECASE)
+
+def _sanitize(text: str) -> str:
+    return _BAD_RE.sub("[removed]", text)
+
+@functools.lru_cache(maxsize=4096)
+def _scene_title(scene_short: str) -> str:
+    short = scene_short.strip()
+    return short[:48].rstrip(" .,!?:;") + ("..." if len(short)>48 else "")
+
+# (field, pool) drawn for every scene, in _build_meta argument order
+_META_POOLS = (
+    ("style", STYLE_POOL),
+    ("mood", MOOD_POOL),
+    ("camera", CAMERA_MOVES),
+    ("color", COLOR_PALETTES),
+    ("adjective", ADJECTIVES),
+)
+
+def _randomize_meta() -> Dict[str,str]:
+    return {field: random.choice(pool) for field, pool in _META_POOLS}
+
+def _build_meta(scene_short: str, style: str, mood: str, camera: str, color: str, adjective: str) -> Dict[str,str]:
     expanded = (
         f"{scene_short}. Details: {adjective} surfaces, {color}. "
         f"Ambience cues: distant hum, soft wind. Lighting: {style} with a {mood} tone. "
         f"Suggested shot: {camera}. Add subtle particle effects and depth-of-field."
     )
-    # basic sanitization: remove very explicit violent verbs
-    for bad in ["разстрелять","убить","убивают","shoot","kill"]:
-        expanded = expanded.replace(bad, "[removed]")
-    return {"title": title, "brief": expanded, "style": style, "mood": mood, "camera": camera, "color": color}
+    return {"title": _scene_title(scene_short), "brief": _sanitize(expanded), "style": style, "mood": mood, "camera": camera, "color": color}
+
+def mini_ai_enhance(scene_short: str) -> Dict[str,str]:
+    return _build_meta(scene_short, **_randomize_meta())
+
+def mini_ai_enhance_batch(scenes_short) -> List[Dict[str,str]]:
+    # sample a whole (n_scenes x fields) table up front: one random.choices call
+    # per column, then rows are read off with zip
+    n = len(scenes_short)
+    columns = [random.choices(pool, k=n) for _, pool in _META_POOLS]
+    return [_build_meta(s, *row) for s, *row in zip(scenes_short, *columns)]
 
 # --- Deepseek integration helper (optional) ---
 DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")  # set this in env if you want remote polishing
 DEEPSEEK_API_URL = os.getenv("DEEPSEEK_API_URL", "https://aimlapi.com/app/api")  # user can override if needed
 
-def call_deepseek_polish(prompt_text: str) -> str:
+DEEPSEEK_MODEL = os.getenv("DEEPSEEK_MODEL", "deepseek-chat")
+DEEPSEEK_TIMEOUT = aiohttp.ClientTimeout(total=12)
+# Sent byte-for-byte identical as the first message of every request, so the
+# provider's prefix (KV) cache can serve it across scenes and users.
+# Never format per-request data into this string.
+DEEPSEEK_SYSTEM = (
+    "You are a cinematic prompt polisher for text-to-image and text-to-video models. "
+    "Rewrite the user's scene prompt to be vivid, concrete and well structured. "
+    "Keep every field line (Style, Mood, Camera, Duration, Negative, Notes) and its meaning. "
+    "Reply with the polished prompt only."
+)
+# batch variant: same stable prefix, fixed suffix describing the array format
+DEEPSEEK_BATCH_SYSTEM = DEEPSEEK_SYSTEM + (
+    "\nIf the user message is a JSON array of prompts, instead reply with only a JSON "
+    "array of polished strings, one per input, in the same order."
+)
+# prompts per batched request; keeps each reply well inside the model's output limit
+DEEPSEEK_BATCH_SIZE = 20
+
+# successful polish results keyed by sha256 of the input text; identical prompts
+# (re-runs of /improve, repeated scenes) skip the HTTP round-trip entirely
+_POLISH_CACHE: "LRUCache[str, str]" = LRUCache(maxsize=4096)
+
+def _polish_key(prompt_text: str) -> str:
+    return hashlib.sha256(prompt_text.encode("utf-8")).hexdigest()
+
+async def call_deepseek_polish(http: aiohttp.ClientSession, prompt_text: str) -> str:
     """
     Polishes the prompt_text via Deepseek (if API key provided).
     This is a best-effort wrapper. The exact endpoint/path may differ depending on provider.
-    We send a JSON POST with {"prompt": "..."} and Authorization header.
+    We send a chat-style JSON POST (fixed system message + the prompt as the user
+    message) with Authorization header over the shared aiohttp session, so many
+    calls can be in flight without blocking the loop.
     If the API call fails, we return the original prompt_text.
     """
     if not DEEPSEEK_API_KEY:
         return prompt_text
+    key = _polish_key(prompt_text)
+    cached = _POLISH_CACHE.get(key)
+    if cached is not None:
+        return cached
+    polished = await _request_polish(http, DEEPSEEK_SYSTEM, prompt_text)
+    if polished is None:
+        return prompt_text
+    _POLISH_CACHE[key] = polished
+    return polished
+
+async def call_deepseek_polish_batch(http: aiohttp.ClientSession, prompt_texts: List[str]) -> List[str]:
+    """
+    Polishes several prompts with a single request: the user message is a JSON
+    array of prompts and the reply must be a JSON array of the same length.
+    Cached prompts are not sent again. If the call fails or the reply does not
+    line up with the input, the original texts are returned.
+    """
+    if not DEEPSEEK_API_KEY:
+        return list(prompt_texts)
+    keys = [_polish_key(t) for t in prompt_texts]
+    results = [_POLISH_CACHE.get(k) for k in keys]
+    misses = [i for i, r in enumerate(results) if r is None]
+    if len(misses) == 1:
+        i = misses[0]
+        results[i] = await call_deepseek_polish(http, prompt_texts[i])
+    elif misses:
+        texts = [prompt_texts[i] for i in misses]
+        polished = await _request_polish_batch(http, texts)
+        for i, text in zip(misses, polished or texts):
+            results[i] = text
+            if polished is not None:
+                _POLISH_CACHE[keys[i]] = text
+    return results
+
+_FENCE_RE = re.compile(r"^```(?:json)?\s*|\s*```$")
+
+async def _request_polish_batch(http: aiohttp.ClientSession, prompt_texts: List[str]) -> Optional[List[str]]:
+    content = await _request_polish(http, DEEPSEEK_BATCH_SYSTEM, _dumps(prompt_texts).decode("utf-8"))
+    if content is None:
+        return None
+    try:
+        polished = _loads(_FENCE_RE.sub("", content))
+    except ValueError:
+        polished = None
+    if (not isinstance(polished, list) or len(polished) != len(prompt_texts)
+            or not all(isinstance(p, str) and p.strip() for p in polished)):
+        logger.warning("Deepseek batch reply did not match %d prompts; keeping originals", len(prompt_texts))
+        return None
+    return [p.strip() for p in polished]
+
+async def _request_polish(http: aiohttp.ClientSession, system: str, user_content: str) -> Optional[str]:
     try:
         headers = {"Authorization": f"Bearer {DEEPSEEK_API_KEY}", "Content-Type": "application/json"}
-        payload = {"prompt": prompt_text}
-        resp = requests.post(DEEPSEEK_API_URL, json=payload, headers=headers, timeout=12)
-        if resp.status_code == 200:
-            data = resp.json()
-            # try common keys
-            if isinstance(data, dict):
-                for key in ("result","output","polished","text"):
-                    if key in data and isinstance(data[key], str) and data[key].strip():
-                        return data[key].strip()
-            # fallback: if response is text
-            if isinstance(data, str):
-                return data
-        else:
-            logger.warning("Deepseek API returned status %s: %s", resp.status_code, resp.text[:200])
+        payload = {
+            "model": DEEPSEEK_MODEL,
+            "messages": [
+                {"role": "system", "content": system},
+                {"role": "user", "content": user_content},
+            ],
+        }
+        # body is encoded/decoded with orjson (when installed) instead of aiohttp's stdlib json
+        async with _API_SEM, http.post(DEEPSEEK_API_URL, data=_dumps(payload), headers=headers, timeout=DEEPSEEK_TIMEOUT) as resp:
+            if resp.status == 200:
+                data = _loads(await resp.read())
+                # try common keys
+                if isinstance(data, dict):
+                    content = _chat_content(data)
+                    if content:
+                        return content
+                    for key in ("result","output","polished","text"):
+                        if key in data and isinstance(data[key], str) and data[key].strip():
+                            return data[key].strip()
+                # fallback: if response is text
+                if isinstance(data, str):
+                    return data
+            else:
+                logger.warning("Deepseek API returned status %s: %s", resp.status, (await resp.text())[:200])
     except Exception as e:
         logger.exception("Deepseek call failed: %s", e)
-    return prompt_text
+    return None
 
-# --- Flow handlers ---
-async def ensure_session(user_id:int):
-    if user_id not in SESSIONS:
-        SESSIONS[user_id] = {"state":"idle","last_prompts":[]}
+def _chat_content(data: Dict[str, Any]) -> Optional[str]:
+    # OpenAI-compatible chat completions: {"choices": [{"message": {"content": "..."}}]}
+    try:
+        content = data["choices"][0]["message"]["content"]
+    except (KeyError, IndexError, TypeError):
+        return None
+    if isinstance(content, str) and content.strip():
+        return content.strip()
+    return None
 
-async def any_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def polish_all(http: aiohttp.ClientSession, prompt_texts: List[str]) -> List[str]:
     """
-    Reply to any non-command message with a friendly menu (so user doesn't have to type /start).
+    Polishes all prompt_texts (each distinct text once) in batched requests of up
+    to DEEPSEEK_BATCH_SIZE prompts; batches run concurrently. Any text whose
+    call failed is kept as is.
     """
-    user_id = update.effective_user.id
-    await ensure_session(user_id)
-    await update.message.reply_text("Main Menu — выбери действие / choose action:", reply_markup=main_menu_kb())
+    unique = list(dict.fromkeys(prompt_texts))
+    batches = [unique[i:i+DEEPSEEK_BATCH_SIZE] for i in range(0, len(unique), DEEPSEEK_BATCH_SIZE)]
+    results = await asyncio.gather(*(call_deepseek_polish_batch(http, b) for b in batches))
+    polished = {}
+    for batch, texts in zip(batches, results):
+        polished.update(zip(batch, texts))
+    return [polished[t] for t in prompt_texts]
+
+# --- Serialization / export helpers ---
+def _dumps(obj: Any) -> bytes:
+    # orjson is a C serializer and returns UTF-8 bytes directly; stdlib json is the fallback
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def _loads(data: bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def _write_session_json(fp, session: Dict[str, Any]):
+    """
+    Writes session to fp as a JSON object, one top-level key per line and one
+    prompt per line inside "last_prompts", so only a single prompt is ever
+    encoded in memory at a time.
+    """
+    fp.write(b"{")
+    sep = b"\n  "
+    for key, value in session.items():
+        fp.write(sep + _dumps(str(key)) + b": ")
+        sep = b",\n  "
+        if key == "last_prompts" and isinstance(value, list):
+            item_sep = b"[\n    "
+            for p in value:
+                fp.write(item_sep + _dumps(p))
+                item_sep = b",\n    "
+            fp.write(b"\n  ]" if value else b"[]")
+        else:
+            fp.write(_dumps(value))
+    fp.write(b"\n}\n" if session else b"}\n")
+
+# exports whose prompt text is smaller than this are stored uncompressed:
+# DEFLATE saves only a few KB there and costs a full pass over the data
+ZIP_STORE_BELOW = 16 * 1024
+
+def _approx_export_size(session: Dict[str, Any]) -> int:
+    # the prompt and brief strings dominate prompts.json; good enough to pick a codec
+    return sum(len(p.get("prompt", "")) + len(p.get("meta", {}).get("brief", ""))
+               for p in session.get("last_prompts", []))
+
+def _build_zip(session: Dict[str, Any]) -> bytes:
+    """
+    Builds prompts.zip (with prompts.json) and returns its bytes.
+    The JSON is streamed straight into the zip entry and the archive is spooled
+    to an anonymous temp file, so the full uncompressed JSON is never held in
+    memory. Small exports are stored as is; larger ones use DEFLATE level 1,
+    which gets most of the size win on this text at a fraction of the default
+    level's CPU cost. Blocking: run it via _run_cpu.
+    """
+    if _approx_export_size(session) < ZIP_STORE_BELOW:
+        method, level = zipfile.ZIP_STORED, None
+    else:
+        method, level = zipfile.ZIP_DEFLATED, 1
+    with tempfile.TemporaryFile() as tmp:
+        with zipfile.ZipFile(tmp, "w", method, compresslevel=level) as zf:
+            with zf.open("prompts.json", "w", force_zip64=True) as entry:
+                _write_session_json(entry, session)
+        tmp.seek(0)
+        return tmp.read()
+
+def _build_msgpack(session: Dict[str, Any]) -> bytes:
+    """
+    Compact binary export: MessagePack drops JSON's quoting/escaping overhead and
+    gzip then squeezes the repeated per-prompt keys ("prompt", "meta", ...).
+    """
+    return gzip.compress(msgpack.packb(session, use_bin_type=True), compresslevel=6)
+
+# finished export bytes per (user, format), tagged with the session _version they
+# were built from; put_session gives every save a fresh random _version, so any
+# change invalidates them (and an expired-then-recreated session can't match)
+_EXPORT_CACHE: "LRUCache[Tuple[int, str], Tuple[str, bytes]]" = LRUCache(maxsize=256)
+
+async def _cached_export(user_id: int, session: Dict[str, Any], fmt: str, build) -> bytes:
+    version = session.get("_version")
+    hit = _EXPORT_CACHE.get((user_id, fmt))
+    if hit is not None and version is not None and hit[0] == version:
+        return hit[1]
+    # shallow snapshot without internal "_" keys, so handlers running meanwhile
+    # can't resize what the thread iterates
+    snapshot = {k: v for k, v in session.items() if not str(k).startswith("_")}
+    snapshot["last_prompts"] = list(session.get("last_prompts", []))
+    data = await _run_cpu(build, snapshot)
+    if version is not None:
+        _EXPORT_CACHE[(user_id, fmt)] = (version, data)
+    return data
+
+async def export_msgpack(user_id: int, session: Dict[str, Any]) -> bytes:
+    return await _cached_export(user_id, session, "msgpack", _build_msgpack)
+
+async def export_zip(user_id: int, session: Dict[str, Any]) -> bytes:
+    return await _cached_export(user_id, session, "zip", _build_zip)
+
+# --- Session persistence ---
+# Two backends behind the same async get/set interface:
+# - SQLiteSessionStore (default): SESSIONS stays as the hot in-process cache and
+#   every change is written through to SESSION_DB, so state survives restarts.
+# - RedisSessionStore (REDIS_URL set): state lives only in Redis, so several
+#   worker processes behind one webhook see the same sessions.
+SESSION_DB = os.getenv("SESSION_DB", "sessions.db")
+# rows untouched for this long are deleted; pruning runs at most every _PRUNE_EVERY s
+SESSION_DB_TTL = int(os.getenv("SESSION_DB_TTL", str(30*24*3600)))
+_PRUNE_EVERY = 3600
+REDIS_URL = os.getenv("REDIS_URL")
+SESSION_REDIS_TTL = int(os.getenv("SESSION_REDIS_TTL", str(24*3600)))
+
+class SessionStore:
+    """
+    Async per-user session storage. get() returns None for unknown users.
+    """
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def get(self, user_id:int) -> Optional[Dict[str, Any]]:
+        return SESSIONS.get(user_id)
+
+    async def set(self, user_id:int, session: Dict[str, Any]):
+        SESSIONS[user_id] = session
+
+class SQLiteSessionStore(SessionStore):
+    def __init__(self, path: str):
+        self.path = path
+        self.db = None  # aiosqlite.Connection, opened in open()
+        self.last_prune = 0.0
+
+    async def open(self):
+        self.db = await aiosqlite.connect(self.path)
+        await self.db.execute("CREATE TABLE IF NOT EXISTS sessions(uid INTEGER PRIMARY KEY, data BLOB, ts INTEGER)")
+        await self.db.commit()
+        await self.prune()
+
+    async def close(self):
+        if self.db is not None:
+            await self.db.close()
+            self.db = None
+
+    async def prune(self):
+        self.last_prune = time.time()
+        cur = await self.db.execute("DELETE FROM sessions WHERE ts < ?", (int(self.last_prune) - SESSION_DB_TTL,))
+        await self.db.commit()
+        if cur.rowcount:
+            logger.info("Pruned %d idle sessions", cur.rowcount)
+
+    async def get(self, user_id:int) -> Optional[Dict[str, Any]]:
+        session = SESSIONS.get(user_id)
+        if session is None and self.db is not None:
+            async with self.db.execute("SELECT data FROM sessions WHERE uid = ?", (user_id,)) as cur:
+                row = await cur.fetchone()
+            if row is not None:
+                session = _loads(row[0])
+        if session is not None:
+            # re-inserting refreshes the TTL, so only idle users get evicted
+            SESSIONS[user_id] = session
+        return session
+
+    async def set(self, user_id:int, session: Dict[str, Any]):
+        SESSIONS[user_id] = session
+        if self.db is None:
+            return
+        await self.db.execute(
+            "INSERT OR REPLACE INTO sessions(uid, data, ts) VALUES (?, ?, ?)",
+            (user_id, _dumps(session), int(time.time())),
+        )
+        await self.db.commit()
+        if time.time() - self.last_prune > _PRUNE_EVERY:
+            await self.prune()
+
+class RedisSessionStore(SessionStore):
+    """
+    Sessions as msgpack blobs under sess:{user_id} with a sliding TTL, reset on
+    every read and write. There is deliberately no local cache: another worker
+    may have changed the session.
+    """
+    def __init__(self, url: str):
+        self.url = url
+        self.redis = None
+
+    async def open(self):
+        if aioredis is None:
+            raise RuntimeError("REDIS_URL is set but the redis package is not installed")
+        self.redis = aioredis.Redis.from_url(self.url)
+
+    async def close(self):
+        if self.redis is not None:
+            await self.redis.aclose()
+            self.redis = None
+
+    async def get(self, user_id:int) -> Optional[Dict[str, Any]]:
+        # GETEX resets the expiry, so reads (export, settings) keep the session alive
+        data = await self.redis.getex(f"sess:{user_id}", ex=SESSION_REDIS_TTL)
+        if data is None:
+            return None
+        return msgpack.unpackb(data, raw=False)
+
+    async def set(self, user_id:int, session: Dict[str, Any]):
+        await self.redis.set(f"sess:{user_id}", msgpack.packb(session, use_bin_type=True), ex=SESSION_REDIS_TTL)
+
+# in-memory only until on_startup swaps in the configured backend
+store: SessionStore = SessionStore()
+
+async def open_session_store(app=None):
+    global store
+    store = RedisSessionStore(REDIS_URL) if REDIS_URL else SQLiteSessionStore(SESSION_DB)
+    await store.open()
+
+async def close_session_store(app=None):
+    global store
+    await store.close()
+    store = SessionStore()
+
+async def get_session(user_id:int) -> Dict[str, Any]:
+    session = await store.get(user_id)
+    if session is None:
+        session = {"state":"idle","last_prompts":[]}
+    return session
+
+async def put_session(user_id:int, session: Dict[str, Any]):
+    # every saved change gets a new, never-repeating version; cached exports of
+    # older ones are stale (a save counter would restart when the session expires)
+    session["_version"] = uuid.uuid4().hex
+    await store.set(user_id, session)
+
+# --- Flow handlers ---
 
 # Menu callback handler
 async def menu_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     user_id = query.from_user.id
-    await ensure_session(user_id)
+    session = await get_session(user_id)
     data = query.data
 
     if data == "menu_create":
         # start create flow: choose language
         await query.edit_message_text(
             "Choose language / Выберите язык:",
-            reply_markup=keyboard_from_list([f"{k} — {v}" for k, v in LANGUAGES.items()], row_size=2)
+            reply_markup=_LANG_KB
         )
-        SESSIONS[user_id]["state"] = "choosing_language"
+        session["state"] = "choosing_language"
+        await put_session(user_id, session)
         return
 
     if data == "menu_improve":
         # run improve on last prompts
-        session = SESSIONS[user_id]
         if not session.get("last_prompts"):
             await query.edit_message_text("No prompts generated yet. Create first.")
             return
-        # apply local improvements
-        improved_prompts = []
-        for p in session["last_prompts"]:
-            enhanced = mini_ai_enhance(p["brief"])
-            improved_prompts.append(enhanced)
-        session["last_prompts"] = improved_prompts
-        await query.edit_message_text("Prompts improved ✨", reply_markup=main_menu_kb())
-        return
-
-        session = SESSIONS[user_id]
-        if not session.get("last_prompts"):
-            await query.edit_message_text("No prompts generated yet. Create first.")
+        # apply local improvements: one palette variation per not-yet-improved
+        # prompt, all drawn up front, each text rebuilt in a single assignment
+        todo = [p for p in session["last_prompts"] if not p["meta"].get("improved")]
+        if not todo:
+            # nothing changes, so don't save (that would invalidate cached exports)
+            await query.edit_message_text("All prompts are already improved.", reply_markup=_MAIN_MENU_KB)
             return
-        # apply local improvements
-        for p in session["last_prompts"]:
-            p["prompt"] += "\\n--IMPROVED: add cinematic grain; try 24fps; experimental color swap"
+        palettes = random.choices(COLOR_PALETTES, k=len(todo))
+        for p, palette in zip(todo, palettes):
+            p["prompt"] = f"{p['prompt']}\n--VARIATION: swap color palette to {palette}\n--HINT: try 24fps for cinematic feel; seed=random"
             p["meta"]["improved"] = True
-        await query.edit_message_text("Prompts improved locally. Use Export to download or /improve for remote polish.")
+            # a remote polish of the old text no longer matches the prompt
+            p.pop("prompt_remote", None)
+        await put_session(user_id, session)
+        await query.edit_message_text("Prompts improved ✨", reply_markup=_MAIN_MENU_KB)
         return
     if data == "menu_export":
-        session = SESSIONS[user_id]
         if not session.get("last_prompts"):
             await query.edit_message_text("No prompts to export. Create first.")
             return
-        # create zip in-memory and send
-        buf = io.BytesIO()
-        with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
-            zf.writestr("prompts.json", json.dumps(session, ensure_ascii=False, indent=2))
-        buf.seek(0)
+        # build the zip off the event loop and send
+        zip_bytes = await export_zip(user_id, session)
         await query.edit_message_text("Exporting prompts.zip...")
-        await context.bot.send_document(chat_id=user_id, document=InputFile(buf, filename="prompts.zip"))
+        await context.bot.send_document(chat_id=user_id, document=InputFile(zip_bytes, filename="prompts.zip"))
+        return
+    if data == "menu_export_msgpack":
+        if not session.get("last_prompts"):
+            await query.edit_message_text("No prompts to export. Create first.")
+            return
+        payload = await export_msgpack(user_id, session)
+        await query.edit_message_text("Exporting prompts.msgpack.gz...")
+        await context.bot.send_document(chat_id=user_id, document=InputFile(payload, filename="prompts.msgpack.gz"))
         return
     if data == "menu_settings":
-        keys = []
-        keys.append([InlineKeyboardButton("Toggle Deepseek (env)", callback_data="setting|deepseek")])
-        keys.append([InlineKeyboardButton("Back to Menu", callback_data="menu_back")])
-        await query.edit_message_text("Settings:", reply_markup=InlineKeyboardMarkup(keys))
+        await query.edit_message_text("Settings:", reply_markup=_SETTINGS_KB)
         return
     if data == "menu_back":
-        await query.edit_message_text("Main Menu:", reply_markup=main_menu_kb())
+        await query.edit_message_text("Main Menu:", reply_markup=_MAIN_MENU_KB)
         return
 
     # Picking language / platform flow
     if data.startswith("pick|"):
         pick = data.split("|",1)[1]
-        user_session = SESSIONS[user_id]
-        state = user_session.get("state")
+        state = session.get("state")
         if state == "choosing_language":
             # store language code (format "ru — Русский")
             lang_code = pick.split(" — ")[0]
-            user_session["language"] = lang_code
-            user_session["state"] = "choosing_platform"
-            await query.edit_message_text("Language set to %s. Now choose platform:" % pick, reply_markup=keyboard_from_list(PLATFORMS, row_size=2))
+            session["language"] = lang_code
+            session["state"] = "choosing_platform"
+            await put_session(user_id, session)
+            await query.edit_message_text("Language set to %s. Now choose platform:" % pick, reply_markup=_PLATFORM_KB)
             return
         if state == "choosing_platform":
-            user_session["platform"] = pick
-            user_session["state"] = "awaiting_description"
+            session["platform"] = pick
+            session["state"] = "awaiting_description"
+            await put_session(user_id, session)
             await query.edit_message_text("Platform set to %s. Send a short description of your idea (one sentence):" % pick)
             return
 
     # fallback
-    await query.edit_message_text("Unhandled menu action. Back to main menu.", reply_markup=main_menu_kb())
+    await query.edit_message_text("Unhandled menu action. Back to main menu.", reply_markup=_MAIN_MENU_KB)
+
+# Telegram rejects messages over 4096 chars; keep some headroom
+CHUNK_SIZE = 3800
 
-# Message handler for collecting description, scenes, duration
+def _emit_chunks(lines: List[str], size: int):
+    """
+    Yields newline-joined groups of lines, each at most `size` chars
+    (a single longer line is yielded on its own).
+    """
+    buf = []
+    n = 0
+    for ln in lines:
+        if buf and n + len(ln) + 1 > size:
+            yield "\n".join(buf)
+            buf = []
+            n = 0
+        buf.append(ln)
+        n += len(ln) + 1
+    if buf:
+        yield "\n".join(buf)
+
+# Single handler for all plain text: collects description, scenes, duration while
+# a flow is active, otherwise replies with the menu (so user doesn't have to type /start)
 async def message_collector(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    await ensure_session(user_id)
-    user_session = SESSIONS[user_id]
+    user_session = await get_session(user_id)
     state = user_session.get("state","idle")
+    if state not in ("awaiting_description", "awaiting_scenes", "awaiting_duration"):
+        await update.message.reply_text("Main Menu — выбери действие / choose action:", reply_markup=_MAIN_MENU_KB)
+        return
     text = update.message.text.strip()
     if state == "awaiting_description":
         user_session["description"] = text
         user_session["state"] = "awaiting_scenes"
+        await put_session(user_id, user_session)
         await update.message.reply_text("Got it. How many scenes? (e.g. 6)")
         return
     if state == "awaiting_scenes":
@@ -260,6 +737,7 @@ async def message_collector(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         user_session["n_scenes"] = n
         user_session["state"] = "awaiting_duration"
+        await put_session(user_id, user_session)
         await update.message.reply_text("Duration per scene in seconds (number) or 'var' for variable durations:")
         return
     if state == "awaiting_duration":
@@ -277,82 +755,129 @@ async def message_collector(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 return
         # ready to generate
         await update.message.reply_text("Generating prompts... (this may take a couple seconds)")
-        prompts = generate_prompts_for_session(user_id)
+        prompts = await generate_prompts_for_session(user_session, context.bot_data.get("http"))
         user_session["last_prompts"] = prompts
         user_session["state"] = "idle"
+        await put_session(user_id, user_session)
         # send short list summary
         lines = [f"Generated {len(prompts)} prompts for {user_session.get('platform')}:"]
         for p in prompts:
             lines.append(f"- Scene {p['index']}: {p['meta']['title']} ({p['duration']}s)")
-        await update.message.reply_text("\\n".join(lines))
-        await update.message.reply_text("Use the menu to Improve or Export. Or click /improve for remote polish.")
+        # hint rides along with the summary instead of costing a separate send
+        lines.append("Use the menu to Improve or Export. Or click /improve for remote polish.")
+        for chunk in _emit_chunks(lines, CHUNK_SIZE):
+            await update.message.reply_text(chunk)
         return
-    # default: show menu
-    await update.message.reply_text("Main Menu:", reply_markup=main_menu_kb())
 
 # Prompt generation logic
-def split_into_scenes(desc: str, n_scenes:int) -> List[str]:
-    import re
+def _grouped(items: List[str], per: int, n: int, sep: str):
+    """
+    Yields at most n groups of `per` consecutive items joined with sep, in a
+    single pass over items; the last group takes whatever is left, so no item
+    is dropped.
+    """
+    it = iter(items)
+    for i in range(n):
+        buf = list(itertools.islice(it, per))
+        if not buf:
+            return
+        if i == n - 1:
+            buf.extend(it)
+        yield sep.join(buf).strip()
+
+def _char_chunks(desc: str, size: int, limit: int) -> List[str]:
+    """
+    At most `limit` stripped parts of `size` chars; the last part runs to the end
+    of desc, so nothing is dropped. Whitespace is trimmed by moving the slice
+    bounds so each part is copied once.
+    """
+    parts = []
+    end = len(desc)
+    for n, i in enumerate(range(0, min(end, limit*size), size), 1):
+        s, e = i, (end if n == limit else min(i+size, end))
+        while s < e and desc[s].isspace():
+            s += 1
+        while e > s and desc[e-1].isspace():
+            e -= 1
+        parts.append(desc[s:e])
+    return parts
+
+# cached: retries with the same description skip the whole split pipeline,
+# so the result is an (immutable) tuple
+@functools.lru_cache(maxsize=512)
+def split_into_scenes(desc: str, n_scenes:int) -> Tuple[str, ...]:
     desc = desc.strip()
     if not desc:
-        return [f"Scene {i+1}" for i in range(n_scenes)]
-    sents = re.split(r'(?<=[.!?])\\s+', desc)
+        return tuple(f"Scene {i+1}" for i in range(n_scenes))
+    if n_scenes == 1:
+        # the whole description is the scene; no splitting needed
+        return (desc,)
+    if TextSplitter is not None and len(desc) >= SPLITTER_MIN_LEN:
+        # native sentence-aware grouping sized so we get ~n_scenes chunks
+        chunks = TextSplitter(max(1, len(desc)//n_scenes)).chunks(desc)
+        if len(chunks) >= n_scenes:
+            # chunks usually come in under capacity, so there are often more than
+            # n_scenes; fold the surplus into the last scene instead of dropping it
+            return tuple(chunks[:n_scenes-1]) + (" ".join(chunks[n_scenes-1:]),)
+    sents = _SENT_RE.split(desc)
     if len(sents) >= n_scenes:
         per = max(1, len(sents)//n_scenes)
-        scenes=[]
-        i=0
-        while len(scenes) < n_scenes and i < len(sents):
-            scenes.append(" ".join(sents[i:i+per]).strip())
-            i += per
+        scenes = list(_grouped(sents, per, n_scenes, " "))
         while len(scenes) < n_scenes:
             scenes.append("A continuing visual scene.")
-        return scenes[:n_scenes]
-    clauses = re.split(r',\\s*', desc)
+        return tuple(scenes)
+    clauses = _CLAUSE_RE.split(desc)
     if len(clauses) >= n_scenes:
         per = max(1, len(clauses)//n_scenes)
-        scenes=[]
-        i=0
-        while len(scenes) < n_scenes and i < len(clauses):
-            scenes.append(", ".join(clauses[i:i+per]).strip())
-            i += per
+        scenes = list(_grouped(clauses, per, n_scenes, ", "))
         while len(scenes) < n_scenes:
             scenes.append("A bridging visual scene.")
-        return scenes[:n_scenes]
+        return tuple(scenes)
     # fallback
     chunk = max(30, len(desc)//n_scenes)
-    parts = [desc[i:i+chunk].strip() for i in range(0,len(desc),chunk)]
-    if len(parts) >= n_scenes:
-        return parts[:n_scenes]
+    parts = _char_chunks(desc, chunk, n_scenes)
     while len(parts) < n_scenes:
         parts.append("A bridging visual scene.")
-    return parts
+    return tuple(parts)
+
+NEGATIVE_PROMPT = "avoid text, logos, watermarks"
+# the Negative/Notes lines are the same for every scene
+_PROMPT_TAIL = f"\nNegative: {NEGATIVE_PROMPT}\nNotes: auto-generated"
+
+def _format_prompt(meta: Dict[str,Any], duration: int) -> str:
+    # a single f-string compiles to one BUILD_STRING: no template parsing or
+    # per-field format() calls at render time
+    return (
+        f"{meta['title']}\n{meta['brief']}\nStyle: {meta['style']}\nMood: {meta['mood']}"
+        f"\nCamera: {meta['camera']}\nDuration: {duration}s{_PROMPT_TAIL}"
+    )
 
-def generate_prompts_for_session(user_id:int) -> List[Dict[str,Any]]:
-    session = SESSIONS[user_id]
+# descriptions longer than this are split in a worker thread so the event loop
+# keeps serving other users meanwhile
+OFFLOAD_LEN = 2000
+
+async def generate_prompts_for_session(session: Dict[str,Any], http: aiohttp.ClientSession = None) -> List[Dict[str,Any]]:
     desc = session.get("description","An idea")
     n = session.get("n_scenes",4)
     dur_mode = session.get("duration_mode","fixed")
     dur_val = session.get("duration_value",6)
     platform = session.get("platform","CustomModel")
-    scenes_short = split_into_scenes(desc, n)
+    if len(desc) > OFFLOAD_LEN:
+        scenes_short = await _run_cpu(split_into_scenes, desc, n)
+        metas = await _run_cpu(mini_ai_enhance_batch, scenes_short)
+    else:
+        scenes_short = split_into_scenes(desc, n)
+        metas = mini_ai_enhance_batch(scenes_short)
+    if dur_mode == "fixed":
+        durations = [dur_val] * len(metas)
+    else:
+        durations = random.choices(range(3,16), k=len(metas))
+    prompt_texts = [_format_prompt(meta, duration) for meta, duration in zip(metas, durations)]
+    # if remote Deepseek available, attempt polishing (best-effort); all scenes go out at once
+    if DEEPSEEK_API_KEY and http is not None:
+        prompt_texts = await polish_all(http, prompt_texts)
     prompts=[]
-    for i,s in enumerate(scenes_short):
-        meta = mini_ai_enhance(s)
-        duration = dur_val if dur_mode=="fixed" else random.randint(3,15)
-        template = (
-            "{title}\\n{brief}\\nStyle: {style}\\nMood: {mood}\\nCamera: {camera}\\nDuration: {duration}s\\nNegative: {negative}\\nNotes: auto-generated"
-        )
-        prompt_text = template.format(
-            title=meta["title"],
-            brief=meta["brief"],
-            style=meta["style"],
-            mood=meta["mood"],
-            camera=meta["camera"],
-            duration=duration,
-            negative="avoid text, logos, watermarks"
-        )
-        # if remote Deepseek available, attempt polishing (best-effort, non-blocking)
-        polished = call_deepseek_polish(prompt_text) if DEEPSEEK_API_KEY else prompt_text
+    for i,(meta,duration,polished) in enumerate(zip(metas, durations, prompt_texts)):
         prompts.append({
             "index": i+1,
             "duration": duration,
@@ -365,42 +890,45 @@ def generate_prompts_for_session(user_id:int) -> List[Dict[str,Any]]:
 # /improve command -> try remote polish (Deepseek) if key present
 async def cmd_improve(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    await ensure_session(user_id)
-    session = SESSIONS[user_id]
+    session = await get_session(user_id)
     if not session.get("last_prompts"):
         await update.message.reply_text("No prompts to improve. Create first.")
         return
     if not DEEPSEEK_API_KEY:
+        # local improvement, once per prompt
+        todo = [p for p in session["last_prompts"] if not p["meta"].get("local_improved")]
+        if not todo:
+            await update.message.reply_text("No remote API key configured, and all prompts already have local improvements.")
+            return
         await update.message.reply_text("No remote API key configured. Improved locally instead.")
-        # local improvement
-        for p in session["last_prompts"]:
-            p["prompt"] += "\\n--LOCAL_IMPROVE: add cinematic color grade and subtle film grain."
+        for p in todo:
+            p["prompt"] = f"{p['prompt']}\n--LOCAL_IMPROVE: add cinematic color grade and subtle film grain."
+            p["meta"]["local_improved"] = True
+            p.pop("prompt_remote", None)
+        await put_session(user_id, session)
         await update.message.reply_text("Local improvements applied. Use Export to download.")
         return
     # Remote polishing loop
     await update.message.reply_text("Polishing prompts with Deepseek...")
-    for p in session["last_prompts"]:
-        try:
-            polished = call_deepseek_polish(p["prompt"])
-            p["prompt_remote"] = polished
-        except Exception as e:
-            logger.exception("Polish failed: %s", e)
+    polished = await polish_all(context.bot_data["http"], [p["prompt"] for p in session["last_prompts"]])
+    for p, text in zip(session["last_prompts"], polished):
+        p["prompt_remote"] = text
+    await put_session(user_id, session)
     await update.message.reply_text("Remote polishing finished. Use /export to download JSON/ZIP.")
 
-# /export command
+# /export command (/export msgpack for the compact binary format)
 async def cmd_export(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    await ensure_session(user_id)
-    session = SESSIONS[user_id]
+    session = await get_session(user_id)
     if not session.get("last_prompts"):
         await update.message.reply_text("No prompts to export.")
         return
-    # create zip in-memory
-    buf = io.BytesIO()
-    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
-        zf.writestr("prompts.json", json.dumps(session, ensure_ascii=False, indent=2))
-    buf.seek(0)
-    await update.message.reply_document(document=InputFile(buf, filename="prompts_export.zip"))
+    if context.args and context.args[0].lower() == "msgpack":
+        payload = await export_msgpack(user_id, session)
+        await update.message.reply_document(document=InputFile(payload, filename="prompts_export.msgpack.gz"))
+        return
+    zip_bytes = await export_zip(user_id, session)
+    await update.message.reply_document(document=InputFile(zip_bytes, filename="prompts_export.zip"))
 
 # /settings command shows info and instructions to set DEEPSEEK_API_KEY
 async def cmd_settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -411,25 +939,70 @@ async def cmd_settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "• The bot will never store your token in the exported prompts.json.",
         "• To change Telegram token, update TG_TOKEN in your host."
     ]
-    await update.message.reply_text("\\n".join(lines))
+    await update.message.reply_text("\n".join(lines))
+
+# Application lifecycle: shared resources live for the whole run
+async def on_startup(app):
+    await open_session_store(app)
+    # one pooled HTTP session for every Deepseek call: keep-alive connections are
+    # reused across requests, so only the first call per connection pays TCP+TLS
+    # the pool never caps below _API_SEM, whatever DEEPSEEK_MAX_CONCURRENCY is
+    connector = aiohttp.TCPConnector(
+        limit=max(64, DEEPSEEK_MAX_CONCURRENCY),
+        limit_per_host=DEEPSEEK_MAX_CONCURRENCY,
+        ttl_dns_cache=300,
+        keepalive_timeout=60,
+    )
+    app.bot_data["http"] = aiohttp.ClientSession(connector=connector)
+
+async def on_shutdown(app):
+    http = app.bot_data.pop("http", None)
+    if http is not None:
+        await http.close()
+    await close_session_store(app)
 
 # Start the bot and handlers
 def main():
     token = os.getenv("TG_TOKEN", "PASTE_YOUR_TOKEN_HERE")
     if token == "PASTE_YOUR_TOKEN_HERE":
         logger.warning("TG_TOKEN not set. Set it in the environment before running.")
-    app = ApplicationBuilder().token(token).build()
+    # AIORateLimiter keeps us under Telegram's flood limits (global + per chat)
+    # and retries RetryAfter instead of failing the send
+    rate_limiter = AIORateLimiter(overall_max_rate=30, overall_time_period=1, max_retries=3)
+    app = (
+        ApplicationBuilder()
+        .token(token)
+        .rate_limiter(rate_limiter)
+        # handle updates from different users in parallel (bounded); network waits
+        # and thread offloads no longer queue every other user behind them
+        .concurrent_updates(PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
     # Handlers
     app.add_handler(CallbackQueryHandler(menu_router))
-    app.add_handler(CommandHandler("menu", lambda u,c: c.bot.send_message(chat_id=u.effective_chat.id, text="Main Menu:", reply_markup=main_menu_kb())))
+    app.add_handler(CommandHandler("menu", lambda u,c: c.bot.send_message(chat_id=u.effective_chat.id, text="Main Menu:", reply_markup=_MAIN_MENU_KB)))
     app.add_handler(CommandHandler("improve", cmd_improve))
     app.add_handler(CommandHandler("export", cmd_export))
     app.add_handler(CommandHandler("settings", cmd_settings))
-    # Any normal message triggers the menu (so user doesn't have to type /start)
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, any_message))
-    # Message collector for the interactive flow (description/scenes/duration)
+    # One handler for all plain text: drives the description/scenes/duration flow
+    # and shows the menu otherwise. PTB runs only the first matching handler per
+    # group, so a separate catch-all here would shadow the flow entirely.
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, message_collector))
-    app.run_polling()
+    webhook_url = os.getenv("WEBHOOK_URL")
+    if webhook_url:
+        # webhook mode: several replicas (sharing sessions via REDIS_URL) can sit
+        # behind one load-balanced HTTPS endpoint
+        app.run_webhook(
+            listen="0.0.0.0",
+            port=int(os.getenv("PORT", "8443")),
+            url_path=os.getenv("WEBHOOK_PATH", ""),
+            webhook_url=webhook_url,
+            secret_token=os.getenv("WEBHOOK_SECRET"),
+        )
+    else:
+        app.run_polling()
 
 if __name__ == "__main__":
     main()